@@ -7,54 +7,115 @@ from sqlalchemy import text
 from database import async_session
 
 # Timeframes to refresh (in order of frequency)
+# refresh_minutes: how often the view's recent window is re-materialized
 TIMEFRAMES = [
-    {"view": "candle_data_5m", "interval_minutes": 5},
-    {"view": "candle_data_15m", "interval_minutes": 15},
-    {"view": "candle_data_1h", "interval_minutes": 60},
-    {"view": "candle_data_4h", "interval_minutes": 240},
-    {"view": "candle_data_1d", "interval_minutes": 1440},
-    {"view": "candle_data_1w", "interval_minutes": 10080},
+    {"view": "candle_data_5m", "interval_minutes": 5, "refresh_minutes": 5},
+    {"view": "candle_data_15m", "interval_minutes": 15, "refresh_minutes": 15},
+    {"view": "candle_data_1h", "interval_minutes": 60, "refresh_minutes": 60},
+    {"view": "candle_data_4h", "interval_minutes": 240, "refresh_minutes": 60},
+    {"view": "candle_data_1d", "interval_minutes": 1440, "refresh_minutes": 60},
+    {"view": "candle_data_1w", "interval_minutes": 10080, "refresh_minutes": 60},
 ]
 
 
-async def refresh_continuous_aggregate(view_name: str):
-    """Refresh a single continuous aggregate view"""
+def refresh_window_minutes(tf: dict) -> int:
+    """
+    Length of the windowed refresh for a view
+    
+    TimescaleDB shrinks the window inward to whole buckets, and the real refresh
+    period drifts (sleep + refresh time). So the window spans at least 3 buckets
+    and stays at least one bucket longer than the refresh period, so a bucket
+    that just closed is always fully inside the next window.
+    
+    Args:
+        tf: Entry of TIMEFRAMES
+    """
+    return max(3 * tf["interval_minutes"], tf["refresh_minutes"] + 2 * tf["interval_minutes"])
+
+
+async def refresh_continuous_aggregate(view_name: str, window_minutes: int | None = None):
+    """
+    Refresh a single continuous aggregate view
+    
+    Args:
+        view_name: Continuous aggregate view
+        window_minutes: Only refresh [now - window_minutes, now]; None refreshes the full range
+    """
+    if window_minutes is None:
+        window = "NULL, NULL"
+    else:
+        # Naive UTC timestamp, like candle_data_1m.timestamp (a timestamptz window is
+        # rejected for TIMESTAMP columns; naive also casts implicitly to timestamptz)
+        window = f"(now() AT TIME ZONE 'UTC') - INTERVAL '{window_minutes} minutes', now() AT TIME ZONE 'UTC'"
+    
     async with async_session() as session:
         try:
             # Use AUTOCOMMIT isolation level for CALL statement
             await session.connection(execution_options={"isolation_level": "AUTOCOMMIT"})
             await session.execute(
-                text(f"CALL refresh_continuous_aggregate('{view_name}', NULL, NULL)")
+                text(f"CALL refresh_continuous_aggregate('{view_name}', {window})")
             )
             print(f"✅ Refreshed {view_name}", flush=True)
         except Exception as e:
             print(f"❌ Error refreshing {view_name}: {e}", flush=True)
 
 
-async def refresh_all_aggregates():
-    """Refresh all continuous aggregates"""
+async def refresh_all_aggregates(full: bool = False):
+    """
+    Refresh all continuous aggregates
+    
+    Args:
+        full: Refresh the whole range instead of the recent window of each view
+    """
     print("🔄 Refreshing all continuous aggregates...", flush=True)
     
-    for tf in TIMEFRAMES:
-        await refresh_continuous_aggregate(tf["view"])
+    # Each view is its own materialized hypertable, so refreshes can run concurrently
+    # (each call uses its own session/connection)
+    await asyncio.gather(
+        *(
+            refresh_continuous_aggregate(tf["view"], None if full else refresh_window_minutes(tf))
+            for tf in TIMEFRAMES
+        ),
+        return_exceptions=True
+    )
     
     print("✅ All aggregates refreshed", flush=True)
 
 
 async def aggregate_refresh_scheduler(interval_minutes: int = 5):
     """
-    Background scheduler to refresh continuous aggregates periodically
+    Background scheduler to refresh continuous aggregates periodically.
+    The first run refreshes the full range (picks up backfilled data); later runs
+    only refresh the recent window (see refresh_window_minutes) of views whose
+    refresh_minutes is due.
     
     Args:
-        interval_minutes: How often to refresh (default: 5 minutes)
+        interval_minutes: How often the scheduler wakes up (default: 5 minutes)
     """
     print(f"🚀 Starting aggregate refresh scheduler (every {interval_minutes} minutes)", flush=True)
     
+    try:
+        await refresh_all_aggregates(full=True)
+    except Exception as e:
+        print(f"❌ Error in aggregate refresh scheduler: {e}", flush=True)
+    
+    elapsed_minutes = 0
+    last_refreshed = {tf["view"]: 0 for tf in TIMEFRAMES}
     while True:
+        # Wait for next refresh
+        await asyncio.sleep(interval_minutes * 60)
+        elapsed_minutes += interval_minutes
+        
         try:
-            await refresh_all_aggregates()
+            due = [
+                tf for tf in TIMEFRAMES
+                if elapsed_minutes - last_refreshed[tf["view"]] >= tf["refresh_minutes"]
+            ]
+            await asyncio.gather(
+                *(refresh_continuous_aggregate(tf["view"], refresh_window_minutes(tf)) for tf in due),
+                return_exceptions=True
+            )
+            for tf in due:
+                last_refreshed[tf["view"]] = elapsed_minutes
         except Exception as e:
             print(f"❌ Error in aggregate refresh scheduler: {e}", flush=True)
-        
-        # Wait for next refresh
-        await asyncio.sleep(interval_minutes * 60)
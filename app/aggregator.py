@@ -1,14 +1,14 @@
 """
 Real-time candle aggregator: Compute 5m/15m/1h/4h/1d/1w from 1m candles
-Simple logic: Query closed 1m candles from DB + current 1m candle = current aggregated candle
+Simple logic: Closed 1m candles (kept in memory, seeded from DB) + current 1m candle = current aggregated candle
 """
 from datetime import datetime, timezone
-from typing import Dict
+from typing import Dict, Tuple
 import asyncio
-import json
-from redis_publisher import RedisPublisher
-from database import async_session
-from sqlalchemy import text
+import logging
+import orjson
+from redis_publisher import publisher
+from db_pool import get_pool, register_statement
 
 # Timeframe configurations (in minutes)
 TIMEFRAME_CONFIGS = {
@@ -22,7 +22,49 @@ TIMEFRAME_CONFIGS = {
 
 AGGREGATOR_TIMEFRAMES = ["5m", "15m", "1h", "4h", "1d", "1w"]
 
-publisher = RedisPublisher()
+# (timeframe, interval_minutes) pairs, resolved once instead of per tick
+TF_TABLE = tuple((tf, TIMEFRAME_CONFIGS[tf]['minutes']) for tf in AGGREGATOR_TIMEFRAMES)
+
+# (symbol, timeframe) -> closed 1m candles of the current bucket:
+# {bucket_start_ms, covered_until_ms, open, high, low, volume, count}
+AGGREGATOR_STATE: Dict[Tuple[str, str], dict] = {}
+
+# (symbol, timeframe) -> (current_candle key, candle channel) as bytes
+REDIS_NAMES: Dict[Tuple[str, str], Tuple[bytes, bytes]] = {}
+
+logger = logging.getLogger(__name__)
+
+
+def _build_aggregate_query():
+    """
+    Build one statement returning the closed 1m aggregate of every timeframe window.
+    Each UNION ALL branch covers one timeframe and is tagged with its interval in minutes.
+    """
+    # $1 = coin_id, $2 = current 1m start (excluded), $3.. = timeframe starts
+    branches = []
+    for i, (tf, interval_minutes) in enumerate(TF_TABLE, start=3):
+        branches.append(f"""
+            SELECT 
+                {interval_minutes} as bucket_minutes,
+                first(open, timestamp) as first_open,
+                MAX(high) as max_high,
+                MIN(low) as min_low,
+                last(close, timestamp) as last_close,
+                SUM(volume) as total_volume,
+                COUNT(*) as candle_count
+            FROM candle_data_1m
+            WHERE coin_id = $1
+                AND timestamp >= to_timestamp(${i})
+                AND timestamp < to_timestamp($2)""")
+    
+    return "\n            UNION ALL".join(branches)
+
+
+AGGREGATE_QUERY = _build_aggregate_query()
+register_statement("aggregate", AGGREGATE_QUERY)
+
+# Seconds to wait for a pool connection / the seed query before skipping this tick
+AGGREGATE_QUERY_TIMEOUT = 2
 
 
 def get_candle_start_time(timestamp_ms: int, interval_minutes: int) -> int:
@@ -36,154 +78,336 @@ def get_candle_start_time(timestamp_ms: int, interval_minutes: int) -> int:
     Returns:
         Start time of the candle in milliseconds
     """
-    timestamp_seconds = timestamp_ms // 1000
-    interval_seconds = interval_minutes * 60
+    step = interval_minutes * 60_000
     
     # Special handling for 1w (10080 minutes) to align with Monday (Binance standard)
     # Unix Epoch (1970-01-01) is Thursday. Monday is +4 days (345600 seconds).
     if interval_minutes == 10080:  # 1w
-        offset = 345600  # 4 days in seconds
-        candle_start = ((timestamp_seconds - offset) // interval_seconds) * interval_seconds + offset
+        offset = 345_600_000  # 4 days in milliseconds
+        return timestamp_ms - ((timestamp_ms - offset) % step)
+    
+    # Round down to the start of the interval
+    return timestamp_ms - (timestamp_ms % step)
+
+
+def _new_state(bucket_start_ms: int, covered_until_ms: int, row=None) -> dict:
+    """
+    Create the closed-candle state of one (symbol, timeframe) bucket
+    
+    Args:
+        bucket_start_ms: Start of the timeframe candle
+        covered_until_ms: 1m start up to which (exclusive) closed candles are included
+        row: Closed 1m aggregate from DB to seed from (or None for an empty bucket)
+    """
+    state = {
+        "bucket_start_ms": bucket_start_ms,
+        "covered_until_ms": covered_until_ms,
+        "open": 0.0,
+        "high": 0.0,
+        "low": 0.0,
+        "volume": 0.0,
+        "count": 0,
+    }
+    if row and row['candle_count'] > 0:
+        state["open"] = float(row['first_open'])
+        state["high"] = float(row['max_high'])
+        state["low"] = float(row['min_low'])
+        state["volume"] = float(row['total_volume'])
+        state["count"] = int(row['candle_count'])
+    return state
+
+
+def _fold_closed_candle(state: dict, candle_1m: dict, candle_1m_start_ms: int):
+    """Merge a closed 1m candle into the bucket state"""
+    if state["count"] == 0:
+        state["open"] = candle_1m['open']
+        state["high"] = candle_1m['high']
+        state["low"] = candle_1m['low']
+    else:
+        state["high"] = max(state["high"], candle_1m['high'])
+        state["low"] = min(state["low"], candle_1m['low'])
+    state["volume"] += candle_1m['volume']
+    state["count"] += 1
+    state["covered_until_ms"] = candle_1m_start_ms + 60_000
+
+
+def _redis_names(symbol: str, tf: str) -> Tuple[bytes, bytes]:
+    """(current_candle key, candle channel) for a symbol/timeframe, encoded once and cached"""
+    names = REDIS_NAMES.get((symbol, tf))
+    if names is None:
+        names = REDIS_NAMES[(symbol, tf)] = (
+            f"current_candle:{symbol}:{tf}".encode(),
+            f"candle:{symbol}:{tf}".encode(),
+        )
+    return names
+
+
+def _partial_key(symbol: str, tf: str, bucket_start_ms: int) -> str:
+    """Redis hash holding the closed-candle state of one bucket (survives restarts)"""
+    return f"partial_agg:{symbol}:{tf}:{bucket_start_ms}"
+
+
+def _state_from_hash(partial: dict) -> dict:
+    """Rebuild bucket state from its Redis hash"""
+    return {
+        "bucket_start_ms": int(partial["bucket_start_ms"]),
+        "covered_until_ms": int(partial["covered_until_ms"]),
+        "open": float(partial["open"]),
+        "high": float(partial["high"]),
+        "low": float(partial["low"]),
+        "volume": float(partial["volume"]),
+        "count": int(partial["count"]),
+    }
+
+
+async def _load_partial_states(symbol: str, stale: list, candle_1m_start_ms: int) -> list:
+    """
+    Restore stale bucket states from Redis partial aggregates
+    
+    Args:
+        symbol: Trading pair
+        stale: (tf, interval_minutes, candle_start_ms) entries needing a seed
+        candle_1m_start_ms: Start of the current 1m candle
+    
+    Returns:
+        Entries that could not be restored (need a DB seed)
+    """
+    try:
+        async with publisher.redis.pipeline(transaction=False) as pipe:
+            for tf, _, candle_start_ms in stale:
+                pipe.hgetall(_partial_key(symbol, tf, candle_start_ms))
+            partials = await pipe.execute()
+    except Exception as e:
+        print(f"❌ Error loading partial aggregates for {symbol}: {e}", flush=True)
+        return stale
+    
+    remaining = []
+    for entry, partial in zip(stale, partials):
+        tf = entry[0]
+        # Only usable if it covers every closed 1m candle up to the current one
+        if partial and int(partial["covered_until_ms"]) == candle_1m_start_ms:
+            AGGREGATOR_STATE[(symbol, tf)] = _state_from_hash(partial)
+        else:
+            remaining.append(entry)
+    return remaining
+
+
+def _aggregate_one(
+    pipe,
+    symbol: str,
+    tf: str,
+    interval_minutes: int,
+    candle_1m: dict,
+    state: dict,
+    candle_1m_start_seconds: int,
+):
+    """
+    Build the current candle of one timeframe and queue its Redis writes
+    
+    Args:
+        pipe: Redis pipeline collecting this tick's commands
+        symbol: Trading pair (e.g., BTCUSDT)
+        tf: Timeframe (5m, 15m, etc.)
+        interval_minutes: Timeframe length in minutes
+        candle_1m: Current 1m candle
+        state: Closed 1m candles of this timeframe's current bucket
+        candle_1m_start_seconds: Start of the current 1m candle
+    """
+    is_closed = candle_1m.get('is_closed', False)
+    candle_start_ms = state["bucket_start_ms"]
+    candle_start_seconds = candle_start_ms // 1000
+    candle_count = state["count"]
+    
+    # Calculate aggregated candle
+    if candle_count > 0:
+        # Have closed 1m candles - combine with current 1m candle
+        open_price = state["open"]
+        high = max(state["high"], candle_1m['high'])
+        low = min(state["low"], candle_1m['low'])
+        close = candle_1m['close']  # Always use current close
+        volume = state["volume"] + candle_1m['volume']
     else:
-        # Round down to the start of the interval
-        candle_start = (timestamp_seconds // interval_seconds) * interval_seconds
+        # No closed candles yet - use current 1m candle only
+        open_price = candle_1m['open']
+        high = candle_1m['high']
+        low = candle_1m['low']
+        close = candle_1m['close']
+        volume = candle_1m['volume']
+    
+    # Determine if this aggregated candle should close
+    # It closes when: current 1m is closed AND we have all 1m candles
+    should_close = is_closed and (candle_count + 1 == interval_minutes)
+    
+    # Create candle update
+    candle_update = {
+        "type": "candle",
+        "symbol": symbol,
+        "timeframe": tf,
+        "timestamp": candle_start_ms,
+        "open": open_price,
+        "high": high,
+        "low": low,
+        "close": close,
+        "volume": volume,
+        "is_closed": should_close
+    }
+    
+    redis_key, channel = _redis_names(symbol, tf)
+    
+    # Save to Redis for API access
+    pipe.setex(
+        redis_key,
+        interval_minutes * 60 + 60,  # TTL = candle duration + 1 min buffer
+        orjson.dumps({
+            "time": candle_start_seconds,
+            "open": open_price,
+            "high": high,
+            "low": low,
+            "close": close,
+            "volume": volume,
+        })
+    )
+    
+    # Publish to WebSocket
+    pipe.publish(channel, orjson.dumps(candle_update))
+    
+    # Log for debugging (LOG_LEVEL=DEBUG)
+    if logger.isEnabledFor(logging.DEBUG) and symbol == "BTCUSDT" and tf in ("5m", "15m", "1h", "1w"):
+        logger.debug(
+            "📊 %s %s: %d/%d candles, O=%.2f, H=%.2f, L=%.2f, C=%.2f, V=%.2f, closed=%s",
+            symbol, tf, candle_count + 1, interval_minutes,
+            open_price, high, low, close, volume, should_close
+        )
+        if tf == "1h":
+            logger.debug(
+                "   🔍 1H Debug: candle_start=%s, 1m_start=%s, is_closed=%s, closed_count=%d",
+                datetime.fromtimestamp(candle_start_seconds, timezone.utc),
+                datetime.fromtimestamp(candle_1m_start_seconds, timezone.utc),
+                is_closed, candle_count
+            )
     
-    return candle_start * 1000
+    # If candle closes, publish close event and clean up Redis
+    if should_close:
+        closed_event = {
+            "type": "candle_closed",
+            "symbol": symbol,
+            "timeframe": tf,
+            "candle": candle_update,
+        }
+        pipe.publish(channel, orjson.dumps(closed_event))
+        pipe.delete(redis_key)
+        print(f"✅ Candle closed: {symbol} {tf} at {datetime.utcfromtimestamp(candle_start_seconds)}", flush=True)
+
+
+def _queue_aggregates(pipe, symbol: str, candle_1m: dict, bucket_starts: list, candle_1m_start_ms: int):
+    """Queue the Redis writes of every timeframe (and fold in a closed 1m candle)"""
+    is_closed = candle_1m.get('is_closed', False)
+    candle_1m_start_seconds = candle_1m_start_ms // 1000
+    
+    for tf, interval_minutes, _ in bucket_starts:
+        state = AGGREGATOR_STATE[(symbol, tf)]
+        try:
+            _aggregate_one(
+                pipe,
+                symbol,
+                tf,
+                interval_minutes,
+                candle_1m,
+                state,
+                candle_1m_start_seconds,
+            )
+        except Exception as e:
+            print(f"❌ Error aggregating {symbol} {tf}: {e}", flush=True)
+        
+        if is_closed:
+            _fold_closed_candle(state, candle_1m, candle_1m_start_ms)
+            
+            # Persist closed-candle state so a restart can resume without a DB scan
+            partial_key = _partial_key(symbol, tf, state["bucket_start_ms"])
+            pipe.hset(partial_key, mapping=state)
+            pipe.expire(partial_key, interval_minutes * 60 + 60)
 
 
-async def aggregate_candle(symbol: str, candle_1m: dict):
+async def aggregate_candle(symbol: str, coin_id: int, candle_1m: dict, pipe):
     """
     Aggregate 1m candle into higher timeframes using simple logic:
     1. Get current 1m candle
-    2. Query closed 1m candles from DB (from timeframe start to now)
+    2. Take closed 1m candles of each timeframe from in-memory state
+       (on cold start restored from Redis partial aggregates, else seeded from DB
+       with all timeframes in one query)
     3. Calculate current aggregated candle = closed 1m candles + current 1m candle
     4. Save to Redis + publish to WebSocket
     5. Client replaces old current candle with new one
+    6. When the 1m candle closes, fold it into the state of every timeframe
+       and save that state to Redis (partial_agg:{symbol}:{tf}:{bucket_start})
     
     Args:
         symbol: Trading pair (e.g., BTCUSDT)
+        coin_id: Database coin ID of the symbol
         candle_1m: 1m candle data with keys: timestamp, open, high, low, close, volume, is_closed
+        pipe: Redis pipeline to queue writes on; the caller executes it
     """
     timestamp_ms = candle_1m['timestamp']
-    is_closed = candle_1m.get('is_closed', False)
     
     # Get 1m candle start time (exclude this from DB query if not closed)
     candle_1m_start_ms = get_candle_start_time(timestamp_ms, 1)
     candle_1m_start_seconds = candle_1m_start_ms // 1000
     
-    # Process each timeframe
-    for tf in AGGREGATOR_TIMEFRAMES:
+    bucket_starts = [
+        (tf, interval_minutes, get_candle_start_time(timestamp_ms, interval_minutes))
+        for tf, interval_minutes in TF_TABLE
+    ]
+    
+    # Find timeframes whose in-memory state does not cover [bucket start, current 1m)
+    stale = []
+    for tf, interval_minutes, candle_start_ms in bucket_starts:
+        state = AGGREGATOR_STATE.get((symbol, tf))
+        if state and state["bucket_start_ms"] == candle_start_ms:
+            if state["covered_until_ms"] == candle_1m_start_ms:
+                continue
+            if state["covered_until_ms"] > candle_1m_start_ms:
+                # Late update for a 1m candle that was already folded in
+                return
+        if candle_start_ms == candle_1m_start_ms:
+            # First minute of a new bucket - nothing closed yet
+            AGGREGATOR_STATE[(symbol, tf)] = _new_state(candle_start_ms, candle_1m_start_ms)
+        else:
+            stale.append((tf, interval_minutes, candle_start_ms))
+    
+    if stale:
+        # Cold start (e.g. restart): try partial aggregates saved in Redis first
+        stale = await _load_partial_states(symbol, stale, candle_1m_start_ms)
+    
+    if stale:
+        # Still missing (or missed minutes): seed from CLOSED 1m candles in DB
+        # IMPORTANT: Exclude current 1m candle timestamp to avoid duplication
+        # We will add it separately below
         try:
-            interval_minutes = TIMEFRAME_CONFIGS[tf]['minutes']
-            
-            # Get timeframe start (e.g., for 5m at 10:04, start is 10:00)
-            candle_start_ms = get_candle_start_time(timestamp_ms, interval_minutes)
-            candle_start_seconds = candle_start_ms // 1000
-            
-            # Query CLOSED 1m candles from DB in this timeframe window
-            # IMPORTANT: Exclude current 1m candle timestamp to avoid duplication
-            # We will add it separately below
-            query = text("""
-                SELECT 
-                    (array_agg(open ORDER BY timestamp))[1] as first_open,
-                    MAX(high) as max_high,
-                    MIN(low) as min_low,
-                    (array_agg(close ORDER BY timestamp DESC))[1] as last_close,
-                    SUM(volume) as total_volume,
-                    COUNT(*) as candle_count
-                FROM candle_data_1m
-                WHERE coin_id = (SELECT id FROM coins WHERE symbol = :symbol LIMIT 1)
-                    AND timestamp >= to_timestamp(:start_time)
-                    AND timestamp < to_timestamp(:exclude_current)
-            """)
-            
-            async with async_session() as session:
-                result = await session.execute(query, {
-                    "symbol": symbol,
-                    "start_time": candle_start_seconds,
-                    "exclude_current": candle_1m_start_seconds
-                })
-                row = result.fetchone()
-            
-            # Calculate aggregated candle
-            if row and row.candle_count > 0:
-                # Have closed 1m candles - combine with current 1m candle
-                open_price = float(row.first_open)
-                high = max(float(row.max_high), candle_1m['high'])
-                low = min(float(row.min_low), candle_1m['low'])
-                close = candle_1m['close']  # Always use current close
-                volume = float(row.total_volume) + candle_1m['volume']
-                candle_count = int(row.candle_count)
-            else:
-                # No closed candles yet - use current 1m candle only
-                open_price = candle_1m['open']
-                high = candle_1m['high']
-                low = candle_1m['low']
-                close = candle_1m['close']
-                volume = candle_1m['volume']
-                candle_count = 0
-            
-            # Determine if this aggregated candle should close
-            # It closes when: current 1m is closed AND we have all 1m candles
-            should_close = is_closed and (candle_count + 1 == interval_minutes)
-            
-            # Create candle update
-            candle_update = {
-                "type": "candle",
-                "symbol": symbol,
-                "timeframe": tf,
-                "timestamp": candle_start_ms,
-                "open": float(open_price),
-                "high": float(high),
-                "low": float(low),
-                "close": float(close),
-                "volume": float(volume),
-                "is_closed": should_close
-            }
-            
-            # Save to Redis for API access
-            redis_key = f"current_candle:{symbol}:{tf}"
-            await publisher.redis.setex(
-                redis_key,
-                interval_minutes * 60 + 60,  # TTL = candle duration + 1 min buffer
-                json.dumps({
-                    "time": candle_start_seconds,
-                    "open": float(open_price),
-                    "high": float(high),
-                    "low": float(low),
-                    "close": float(close),
-                    "volume": float(volume),
-                })
-            )
-            
-            # Publish to WebSocket
-            channel = f"candle:{symbol}:{tf}"
-            await publisher.publish_price(channel, candle_update)
-            
-            # Log for debugging
-            if symbol == "BTCUSDT" and tf in ["5m", "15m", "1h", "1w"]:
-                print(f"📊 {symbol} {tf}: {candle_count+1}/{interval_minutes} candles, "
-                      f"O={open_price:.2f}, H={high:.2f}, L={low:.2f}, C={close:.2f}, "
-                      f"V={volume:.2f}, closed={should_close}", flush=True)
-                if tf == "1h":
-                    print(f"   🔍 1H Debug: candle_start={datetime.utcfromtimestamp(candle_start_seconds)}, "
-                          f"1m_start={datetime.utcfromtimestamp(candle_1m_start_seconds)}, "
-                          f"is_closed={is_closed}, db_count={candle_count}", flush=True)
-            
-            # If candle closes, publish close event and clean up Redis
-            if should_close:
-                closed_event = {
-                    "type": "candle_closed",
-                    "symbol": symbol,
-                    "timeframe": tf,
-                    "candle": candle_update,
-                }
-                await publisher.publish_price(channel, closed_event)
-                await publisher.redis.delete(redis_key)
-                print(f"✅ Candle closed: {symbol} {tf} at {datetime.utcfromtimestamp(candle_start_seconds)}", flush=True)
-        
+            # Bounded wait: a slow DB must not stall this symbol's worker for long
+            # (pool creation included, in case the startup pool is gone)
+            pool = await asyncio.wait_for(get_pool(), AGGREGATE_QUERY_TIMEOUT)
+            async with pool.acquire(timeout=AGGREGATE_QUERY_TIMEOUT) as conn:
+                result = await conn.prepared["aggregate"].fetch(
+                    coin_id,
+                    candle_1m_start_seconds,
+                    *(candle_start_ms // 1000 for _, _, candle_start_ms in bucket_starts),
+                    timeout=AGGREGATE_QUERY_TIMEOUT
+                )
+            rows = {row['bucket_minutes']: row for row in result}
+        except asyncio.TimeoutError:
+            print(f"❌ Timed out querying aggregates for {symbol}, skipping this tick", flush=True)
+            return
         except Exception as e:
-            print(f"❌ Error aggregating {symbol} {tf}: {e}", flush=True)
+            print(f"❌ Error querying aggregates for {symbol}: {e}", flush=True)
+            return
+        
+        for tf, interval_minutes, candle_start_ms in stale:
+            AGGREGATOR_STATE[(symbol, tf)] = _new_state(
+                candle_start_ms, candle_1m_start_ms, rows.get(interval_minutes)
+            )
+    
+    # Caller executes the pipeline together with its own publishes
+    _queue_aggregates(pipe, symbol, candle_1m, bucket_starts, candle_1m_start_ms)
 
 
 async def save_aggregated_candle(symbol: str, timeframe: str, candle: dict, table_name: str):
@@ -2,15 +2,49 @@
 Backfill missing candle data from Binance REST API
 """
 import asyncio
+import time
 import httpx
+from aiolimiter import AsyncLimiter
 from datetime import datetime, timedelta, timezone
 from sqlalchemy import text
 from database import async_session
+from db_pool import upsert_candles_1m
 from config import SYMBOLS
 
 # Binance REST API endpoint
 BINANCE_API_URL = "https://api.binance.com/api/v3/klines"
 
+# Unix epoch as naive UTC datetime (matches the naive timestamps stored in DB)
+EPOCH = datetime(1970, 1, 1)
+
+# Shared HTTP client (keep-alive connections reused across requests)
+_http_client: httpx.AsyncClient | None = None
+
+# Max in-flight Binance requests across all symbols
+MAX_CONCURRENT_REQUESTS = 10
+_request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Binance IP limit: 1200 request weight per minute; klines with limit=1000 weighs 2
+KLINES_REQUEST_WEIGHT = 2
+_rate_limiter = AsyncLimiter(1200, 60)
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+        )
+    return _http_client
+
+async def close_client():
+    """Close the shared HTTP client (backfill only runs at startup)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 async def get_latest_timestamp(coin_id: int) -> datetime | None:
     """Get the latest candle timestamp from database for a coin"""
     async with async_session() as session:
@@ -47,56 +81,76 @@ async def fetch_binance_klines(symbol: str, interval: str, start_time: int, end_
         "limit": limit
     }
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(BINANCE_API_URL, params=params)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(f"❌ Error fetching {symbol} klines: {e}", flush=True)
-            return []
+    try:
+        response = await get_client().get(BINANCE_API_URL, params=params)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        print(f"❌ Error fetching {symbol} klines: {e}", flush=True)
+        return []
 
 async def insert_candles_batch(coin_id: int, candles: list):
-    """Bulk insert candles into database"""
+    """Bulk insert candles into database (COPY + upsert via asyncpg)"""
     if not candles:
         return 0
     
-    async with async_session() as session:
-        try:
-            # Prepare batch insert
-            values = []
-            for candle in candles:
-                timestamp = datetime.utcfromtimestamp(candle[0] / 1000)
-                values.append({
-                    "coin_id": coin_id,
-                    "timestamp": timestamp,
-                    "open": float(candle[1]),
-                    "high": float(candle[2]),
-                    "low": float(candle[3]),
-                    "close": float(candle[4]),
-                    "volume": float(candle[5])
-                })
-            
-            # Bulk insert with ON CONFLICT
-            await session.execute(
-                text("""
-                    INSERT INTO candle_data_1m (coin_id, timestamp, open, high, low, close, volume)
-                    VALUES (:coin_id, :timestamp, :open, :high, :low, :close, :volume)
-                    ON CONFLICT (coin_id, timestamp) DO UPDATE
-                    SET open = EXCLUDED.open,
-                        high = EXCLUDED.high,
-                        low = EXCLUDED.low,
-                        close = EXCLUDED.close,
-                        volume = EXCLUDED.volume
-                """),
-                values
+    # Skip the still-open current minute (kline[6] = close time):
+    # the live stream writes it once closed, and that insert never overwrites
+    now_ms = int(time.time() * 1000)
+    
+    try:
+        # Naive UTC timestamps, computed from epoch ms without utcfromtimestamp
+        records = [
+            (
+                coin_id,
+                EPOCH + timedelta(milliseconds=candle[0]),
+                float(candle[1]),
+                float(candle[2]),
+                float(candle[3]),
+                float(candle[4]),
+                float(candle[5])
             )
-            await session.commit()
-            return len(candles)
-        except Exception as e:
-            print(f"❌ Error inserting batch: {e}", flush=True)
-            await session.rollback()
-            return 0
+            for candle in candles
+            if candle[6] < now_ms
+        ]
+        
+        return await upsert_candles_1m(records)
+    except Exception as e:
+        print(f"❌ Error inserting batch: {e}", flush=True)
+        return 0
+
+async def backfill_window(symbol: str, coin_id: int, window_start: datetime, window_end: datetime) -> int:
+    """
+    Fetch and insert one window (max 1000 minutes) of 1m candles
+    
+    Args:
+        symbol: Trading pair (e.g., BTCUSDT)
+        coin_id: Database coin ID
+        window_start: Window start (UTC, naive)
+        window_end: Window end (UTC, naive)
+    
+    Returns:
+        Number of candles inserted
+    """
+    # Convert to milliseconds
+    start_ms = int(window_start.timestamp() * 1000)
+    end_ms = int(window_end.timestamp() * 1000)
+    
+    async with _request_semaphore:
+        print(f"    📊 Fetching {symbol} {window_start} to {window_end}...", flush=True)
+        
+        # Fetch from Binance (rate limited by request weight)
+        await _rate_limiter.acquire(KLINES_REQUEST_WEIGHT)
+        klines = await fetch_binance_klines(symbol, "1m", start_ms, end_ms)
+    
+    if not klines:
+        print(f"    ⚠️  No data returned from Binance for {symbol} {window_start}", flush=True)
+        return 0
+    
+    # Insert batch
+    inserted = await insert_candles_batch(coin_id, klines)
+    print(f"    ✅ Inserted {inserted} {symbol} candles", flush=True)
+    return inserted
 
 async def backfill_symbol(symbol: str, coin_id: int, max_gap_hours: int = 24 * 30):
     """
@@ -139,39 +193,24 @@ async def backfill_symbol(symbol: str, coin_id: int, max_gap_hours: int = 24 * 3
     # Binance limit: 1000 candles per request
     # For 1m interval: 1000 minutes = ~16.6 hours per request
     end_time = now
+    windows = []
     current_start = start_time
-    total_inserted = 0
-    
     while current_start < end_time:
         # Calculate end of current batch (max 1000 minutes)
         current_end = min(
             current_start + timedelta(minutes=1000),
             end_time
         )
-        
-        # Convert to milliseconds
-        start_ms = int(current_start.timestamp() * 1000)
-        end_ms = int(current_end.timestamp() * 1000)
-        
-        print(f"    📊 Fetching {current_start} to {current_end}...", flush=True)
-        
-        # Fetch from Binance
-        klines = await fetch_binance_klines(symbol, "1m", start_ms, end_ms)
-        
-        if not klines:
-            print(f"    ⚠️  No data returned from Binance", flush=True)
-            break
-        
-        # Insert batch
-        inserted = await insert_candles_batch(coin_id, klines)
-        total_inserted += inserted
-        print(f"    ✅ Inserted {inserted} candles", flush=True)
+        windows.append((current_start, current_end))
         
         # Move to next batch
         current_start = current_end + timedelta(minutes=1)
-        
-        # Rate limit: wait 100ms between requests
-        await asyncio.sleep(0.1)
+    
+    # Fetch + insert all windows concurrently (bounded by semaphore + rate limiter)
+    results = await asyncio.gather(
+        *(backfill_window(symbol, coin_id, window_start, window_end) for window_start, window_end in windows)
+    )
+    total_inserted = sum(results)
     
     print(f"  🎉 {symbol} backfill complete: {total_inserted} candles inserted", flush=True)
     return total_inserted
@@ -196,7 +235,10 @@ async def backfill_all_symbols(coin_ids: dict, max_gap_hours: int = 24 * 30):
         task = backfill_symbol(symbol, coin_id, max_gap_hours)
         tasks.append(task)
     
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await close_client()
     
     total = sum(r for r in results if isinstance(r, int))
     errors = []
@@ -1,164 +1,227 @@
-import json
 import asyncio
+import logging
+import random
 import websockets
 import sys
 from config import (
     BINANCE_WS_BASE, SYMBOLS, TIMEFRAMES, MAX_BACKFILL_HOURS,
-    CLEANUP_ENABLED, RETENTION_DAYS_1M, CLEANUP_INTERVAL_HOURS
+    CLEANUP_ENABLED, RETENTION_DAYS_1M, CLEANUP_INTERVAL_HOURS,
+    BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
 )
-from redis_publisher import RedisPublisher
-from models.price_event import PriceEvent
+from redis_publisher import publisher
+from models.binance_kline import KlineEvent, kline_stream_decoder
+import msgspec
+import orjson
 from database import async_session
+from db_pool import get_pool, close_pool
+from candle_writer import CandleWriteBuffer
 from sqlalchemy import text
-from datetime import datetime
-import time
+from types import MappingProxyType
 from backfill import backfill_all_symbols
 from cleanup import cleanup_scheduler
 from aggregator import aggregate_candle
 from aggregate_refresher import aggregate_refresh_scheduler
 
-publisher = RedisPublisher()
+# Closed 1m candles are batched into bulk upserts
+candle_buffer = CandleWriteBuffer()
 
-# Load coin IDs from database
-coin_ids = {}
+# Frame queues between the WebSocket reader and the message workers
+MAX_MESSAGE_WORKERS = 4
+MAX_QUEUED_FRAMES = 10_000
+dropped_frames = 0
+processed_frames = 0
+
+# Reconnect delay (seconds): doubles after each failed attempt, reset once connected
+RECONNECT_BACKOFF_MIN = 1
+RECONNECT_BACKOFF_MAX = 60
+
+# Progress line every N frames at INFO; per-frame details only at DEBUG
+FRAMES_PER_PROGRESS_LOG = 1000
+
+# Redis channel names encoded once per symbol/timeframe instead of per frame
+CANDLE_CHANNELS = {
+    (symbol.upper(), tf): f"candle:{symbol.upper()}:{tf}".encode()
+    for symbol in SYMBOLS
+    for tf in TIMEFRAMES
+}
+PRICE_CHANNELS = {symbol.upper(): f"price:{symbol.upper()}".encode() for symbol in SYMBOLS}
+
+logger = logging.getLogger(__name__)
+
+# Load coin IDs from database (read-only after load_coin_ids)
+coin_ids = MappingProxyType({})
 
 async def load_coin_ids():
     global coin_ids
+    loaded = {}
     async with async_session() as session:
         result = await session.execute(text("SELECT id, symbol FROM coins"))
         for row in result:
-            symbol = row.symbol
-            coin_ids[symbol] = row.id
+            # Key by Binance pair symbol (e.g., BTCUSDT) whether DB stores "BTC" or "BTCUSDT"
+            symbol = row.symbol.upper()
+            if not symbol.endswith("USDT"):
+                symbol += "USDT"
+            loaded[symbol] = row.id
+    coin_ids = MappingProxyType(loaded)
     print(f"Loaded {len(coin_ids)} coin IDs", flush=True)
 
-async def save_candle(symbol: str, timeframe: str, candle_data: dict):
-    """Save closed 1m candle to database"""
-    if symbol not in coin_ids:
-        print(f"Coin ID not found for {symbol}", flush=True)
-        return
-    
-    # Only save 1m candles to DB
-    # Other timeframes will be computed by aggregator and saved when complete
-    if timeframe != "1m":
-        return
-    
-    coin_id = coin_ids[symbol]
-    kline = candle_data['k']
-    
-    # Convert timestamp to datetime
-    timestamp = datetime.utcfromtimestamp(kline['t'] / 1000)
-    
-    async with async_session() as session:
-        try:
-            query = text("""
-                INSERT INTO candle_data_1m (coin_id, timestamp, open, high, low, close, volume)
-                VALUES (:coin_id, :timestamp, :open, :high, :low, :close, :volume)
-                ON CONFLICT (coin_id, timestamp) DO UPDATE
-                SET open = EXCLUDED.open,
-                    high = EXCLUDED.high,
-                    low = EXCLUDED.low,
-                    close = EXCLUDED.close,
-                    volume = EXCLUDED.volume
-            """)
-            
-            await session.execute(
-                query,
-                {
-                    "coin_id": coin_id,
-                    "timestamp": timestamp,
-                    "open": float(kline['o']),
-                    "high": float(kline['h']),
-                    "low": float(kline['l']),
-                    "close": float(kline['c']),
-                    "volume": float(kline['v'])
-                }
-            )
-            await session.commit()
-        except Exception as e:
-            print(f"Error saving candle: {e}", flush=True)
-            await session.rollback()
+def save_candle(coin_id: int, candle: dict):
+    """Queue closed 1m candle for the buffered DB writer"""
+    # Epoch-ms timestamp is converted by the writer, off the message path
+    candle_buffer.put((
+        coin_id,
+        candle['timestamp'],
+        candle['open'],
+        candle['high'],
+        candle['low'],
+        candle['close'],
+        candle['volume']
+    ))
 
-async def publish_candle_update(symbol: str, timeframe: str, kline: dict, is_closed: bool):
-    """Publish candle update to Redis for realtime chart"""
+def candle_update_event(symbol: str, timeframe: str, candle: dict) -> tuple[str | bytes, dict]:
+    """Build candle update event for realtime chart"""
+    # candle already holds timestamp, open, high, low, close, volume, is_closed
+    # in wire order, so unpack it instead of copying key by key
     candle_update = {
         "type": "candle",
         "symbol": symbol,
         "timeframe": timeframe,
-        "timestamp": kline['t'],
-        "open": float(kline['o']),
-        "high": float(kline['h']),
-        "low": float(kline['l']),
-        "close": float(kline['c']),
-        "volume": float(kline['v']),
-        "is_closed": is_closed
+        **candle
     }
     
-    # Publish to candle channel: candle:{SYMBOL}:{timeframe}
-    channel = f"candle:{symbol}:{timeframe}"
-    await publisher.publish_price(channel, candle_update)
-
-async def publish_price_update(symbol: str, price: float, timestamp: int):
-    """Publish current price to Redis for price ticker"""
-    event = PriceEvent(
-        symbol=symbol,
-        price=price,
-        timestamp=timestamp
-    )
-    channel = f"price:{symbol}"
-    await publisher.publish_price(channel, event.dict())
-
-async def handle_message(message: str):
-    """Handle incoming Binance WebSocket message"""
-    data = json.loads(message)
-    
-    # DEBUG: Log message receipt
-    print(f"📨 Received message from Binance", flush=True)
-    
-    # Combined stream payload has 'data' wrapper
-    if 'data' in data:
-        data = data['data']
-    
-    kline = data.get('k')
-    if not kline:
-        return
+    # Candle channel: candle:{SYMBOL}:{timeframe}
+    channel = CANDLE_CHANNELS.get((symbol, timeframe)) or f"candle:{symbol}:{timeframe}"
+    return channel, candle_update
+
+def price_update_event(symbol: str, price: float, timestamp: int) -> tuple[str | bytes, dict]:
+    """Build current price event for price ticker (same fields as PriceEvent)"""
+    # Plain dict: values are already typed, pydantic validation/.dict() adds nothing here
+    event = {
+        "symbol": symbol,
+        "price": price,
+        "timestamp": timestamp,
+        "source": "binance"
+    }
+    return PRICE_CHANNELS.get(symbol) or f"price:{symbol}", event
+
+def parse_message(message: bytes) -> KlineEvent | None:
+    """Decode a Binance combined-stream frame into its kline event (None if not a kline)"""
+    try:
+        # Combined stream payload has 'data' wrapper
+        return kline_stream_decoder.decode(message).data
+    except msgspec.DecodeError:
+        return None
+
+async def handle_message(event: KlineEvent, coin_id: int | None, pipe):
+    """
+    Handle a decoded Binance kline event
     
-    symbol = kline['s']  # e.g., BTCUSDT
-    timeframe = kline['i']  # e.g., 1m, 5m, 1h, etc.
-    price = float(kline['c'])
-    timestamp = int(time.time() * 1000)
-    is_closed = kline['x']  # True if candle is closed
+    Args:
+        event: Decoded kline event
+        coin_id: Database coin ID of the symbol, resolved when the frame was routed
+            (None if the symbol is not in the coins table)
+        pipe: Redis pipeline the Redis writes are queued on; the caller executes it
+    """
+    kline = event.k
+    symbol = kline.s  # e.g., BTCUSDT
+    timeframe = kline.i  # e.g., 1m, 5m, 1h, etc.
+    timestamp = event.E  # Binance event time (ms), no local clock read
+    is_closed = kline.x  # True if candle is closed
+    
+    # Parse prices once; reused by the publishers and the aggregator
+    candle = {
+        "timestamp": kline.t,
+        "open": float(kline.o),
+        "high": float(kline.h),
+        "low": float(kline.l),
+        "close": float(kline.c),
+        "volume": float(kline.v),
+        "is_closed": is_closed
+    }
     
-    # DEBUG
-    print(f"[Binance WS] {symbol} {timeframe} is_closed={is_closed}", flush=True)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📨 %s %s is_closed=%s", symbol, timeframe, is_closed)
     
-    # Publish candle update for this timeframe (Aggregator handles higher timeframes)
+    # Candle update for this timeframe (Aggregator handles higher timeframes)
     # Frontend needs these to detect candle close events
-    await publish_candle_update(symbol, timeframe, kline, is_closed)
-    print(f"[Binance WS] Published candle:{symbol}:{timeframe}", flush=True)
+    channel, data = candle_update_event(symbol, timeframe, candle)
+    pipe.publish(channel, orjson.dumps(data))
     
-    # Publish price update (only for 1m to avoid duplicates)
-    if timeframe == "1m":
-        await publish_price_update(symbol, price, timestamp)
-        print(f"[Binance WS] Published price:{symbol}", flush=True)
+    if timeframe != "1m":
+        return
+    
+    # Price update (only for 1m to avoid duplicates)
+    # Queued right after its candle on the same pipeline: both go out in one write,
+    # in order, so subscribers never see a price before the candle it belongs to
+    channel, data = price_update_event(symbol, candle['close'], timestamp)
+    pipe.publish(channel, orjson.dumps(data))
     
     # For 1m candles: save to DB and aggregate to higher timeframes
-    if timeframe == "1m":
-        if is_closed:
-            await save_candle(symbol, timeframe, data)
+    # Other timeframes will be computed by aggregator
+    if coin_id is None:
+        return
+    
+    if is_closed:
+        save_candle(coin_id, candle)
+    
+    # Aggregate to 5m/15m/1h/4h/1d/1w
+    await aggregate_candle(symbol, coin_id, candle, pipe)
+
+def enqueue_frame(queue: asyncio.Queue, item: tuple[KlineEvent, int | None]):
+    """Queue a decoded frame (with its coin ID) for its worker, dropping the oldest one when full"""
+    global dropped_frames
+    if queue.full():
+        queue.get_nowait()
+        dropped_frames += 1
+        if dropped_frames % 1000 == 1:
+            print(f"⚠️  Frame queue full, dropped {dropped_frames} oldest frames so far", flush=True)
+    queue.put_nowait(item)
+
+async def next_batch(queue: asyncio.Queue) -> list:
+    """Wait for a frame, then collect more until the batch is full or the wait window ends"""
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + BATCH_MAX_WAIT_MS / 1000
+    
+    while len(batch) < BATCH_MAX_SIZE:
+        if not queue.empty():
+            batch.append(queue.get_nowait())
+            continue
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    
+    return batch
+
+async def message_worker(queue: asyncio.Queue):
+    """Process queued frames in micro-batches (keeps per-symbol order)"""
+    global processed_frames
+    while True:
+        batch = await next_batch(queue)
+        
+        # Redis writes of the whole batch go out in one pipelined round-trip,
+        # sent in the background so the worker does not wait for replies
+        pipe = publisher.pipeline()
+        for event, coin_id in batch:
+            try:
+                await handle_message(event, coin_id, pipe)
+            except Exception as e:
+                print(f"❌ Error handling message: {e}", flush=True)
         
-        # Aggregate to 5m/15m/1h/4h/1d/1w
-        # DISABLED: Using TimescaleDB continuous aggregates instead
-        # Real-time aggregation was causing incorrect data
-        candle_1m = {
-            "timestamp": kline['t'],
-            "open": float(kline['o']),
-            "high": float(kline['h']),
-            "low": float(kline['l']),
-            "close": float(kline['c']),
-            "volume": float(kline['v']),
-            "is_closed": is_closed
-        }
-        await aggregate_candle(symbol, candle_1m)
+        try:
+            await publisher.send(pipe)
+            logger.debug("[Binance WS] Queued %d frames for publish", len(batch))
+        except Exception as e:
+            print(f"❌ Error publishing {len(batch)} frames: {e}", flush=True)
+        
+        previous = processed_frames
+        processed_frames += len(batch)
+        if processed_frames // FRAMES_PER_PROGRESS_LOG != previous // FRAMES_PER_PROGRESS_LOG:
+            logger.info("📈 Processed %d frames from Binance", processed_frames)
 
 async def stream_all_symbols():
     """
@@ -181,18 +244,63 @@ async def stream_all_symbols():
     # Use combined stream endpoint (single connection for all streams)
     url = f"wss://stream.binance.com:9443/stream?streams={'/'.join(streams)}"
     
-    while True:
-        try:
-            async with websockets.connect(url, ping_interval=20, ping_timeout=10) as ws:
-                print(f"✅ Connected to Binance with {total_streams} streams via single connection", flush=True)
-                sys.stdout.flush()
-                
-                async for msg in ws:
-                    await handle_message(msg)
+    # Socket reads never wait on DB/Redis: frames go to worker queues.
+    # Each symbol is pinned to one worker so its ticks stay in order.
+    num_workers = max(1, min(MAX_MESSAGE_WORKERS, len(SYMBOLS)))
+    queues = [asyncio.Queue(maxsize=MAX_QUEUED_FRAMES) for _ in range(num_workers)]
+    
+    # symbol -> (worker queue, coin ID): one lookup per frame routes it and resolves its coin
+    symbol_routes = {}
+    for i, symbol in enumerate(SYMBOLS):
+        symbol = symbol.upper()
+        coin_id = coin_ids.get(symbol)
+        if coin_id is None:
+            print(f"Coin ID not found for {symbol}, candles will not be saved or aggregated", flush=True)
+        symbol_routes[symbol] = (queues[i % num_workers], coin_id)
+    fallback_route = (queues[0], None)
+    
+    workers = [asyncio.create_task(message_worker(queue)) for queue in queues]
+    
+    backoff = RECONNECT_BACKOFF_MIN
+    
+    try:
+        while True:
+            try:
+                # Klines are tiny JSON frames: permessage-deflate costs more CPU than it saves
+                # max_queue=None: back-pressure is handled by the worker queues (drop oldest)
+                async with websockets.connect(
+                    url,
+                    ping_interval=20,
+                    ping_timeout=10,
+                    open_timeout=5,
+                    close_timeout=1,
+                    compression=None,
+                    max_size=2**20,
+                    max_queue=None
+                ) as ws:
+                    print(f"✅ Connected to Binance with {total_streams} streams via single connection", flush=True)
+                    backoff = RECONNECT_BACKOFF_MIN
+                    sys.stdout.flush()
                     
-        except Exception as e:
-            print(f"❌ Connection error: {e}, reconnecting in 3s...", flush=True)
-            await asyncio.sleep(3)
+                    # Read raw frame bytes: the decoder parses UTF-8 itself,
+                    # so skip the per-frame str decode
+                    while True:
+                        msg = await ws.recv(decode=False)
+                        event = parse_message(msg)
+                        if event is None:
+                            continue
+                        queue, coin_id = symbol_routes.get(event.k.s, fallback_route)
+                        enqueue_frame(queue, (event, coin_id))
+                        
+            except Exception as e:
+                # Exponential backoff with jitter so reconnects don't hammer Binance
+                delay = backoff + random.random()
+                print(f"❌ Connection error: {e}, reconnecting in {delay:.1f}s...", flush=True)
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+    finally:
+        for worker in workers:
+            worker.cancel()
 
 async def start():
     """Main entry point"""
@@ -204,6 +312,9 @@ async def start():
     # Load coin IDs from database
     await load_coin_ids()
     
+    # Open the asyncpg pool up front so workers never wait on its creation
+    await get_pool()
+    
     # Backfill missing data before starting realtime stream
     print("\n🔄 Checking for missing data gaps...", flush=True)
     await backfill_all_symbols(coin_ids, max_gap_hours=MAX_BACKFILL_HOURS)
@@ -223,5 +334,17 @@ async def start():
     # Start aggregate refresh scheduler in background (every 5 minutes)
     asyncio.create_task(aggregate_refresh_scheduler(interval_minutes=5))
     
+    # Start buffered writer for closed 1m candles
+    candle_buffer.start()
+    
+    # Start background Redis sender (workers do not wait for publish replies)
+    publisher.start()
+    
     # Start streaming (single connection for all)
-    await stream_all_symbols()
+    try:
+        await stream_all_symbols()
+    finally:
+        # Flush buffered candles and queued publishes before shutting down
+        await publisher.close()
+        await candle_buffer.close()
+        await close_pool()
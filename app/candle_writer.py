@@ -0,0 +1,89 @@
+"""
+Buffered writer for closed 1m candles
+Candles arriving close together are flushed to DB as one batched upsert
+"""
+import asyncio
+from datetime import datetime, timedelta
+from db_pool import insert_candles_1m
+from config import CANDLE_FLUSH_MAX_ROWS, CANDLE_FLUSH_MAX_WAIT_MS
+
+EPOCH = datetime(1970, 1, 1)
+
+# Sentinel telling the flush loop to stop
+_STOP = object()
+
+
+class CandleWriteBuffer:
+
+    def __init__(self, max_rows: int = CANDLE_FLUSH_MAX_ROWS, max_wait_ms: int = CANDLE_FLUSH_MAX_WAIT_MS):
+        """
+        Args:
+            max_rows: Flush once this many candles are buffered
+            max_wait_ms: Flush at most this long after the first buffered candle
+        """
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        """Start the background flush loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, record: tuple):
+        """
+        Buffer one candle (never waits: the queue is unbounded and the DB
+        write happens on the flush loop)
+        
+        Args:
+            record: (coin_id, timestamp_ms, open, high, low, close, volume)
+                with the candle open time as epoch milliseconds
+        """
+        self.queue.put_nowait(record)
+
+    async def close(self):
+        """Flush everything still buffered and stop the flush loop (on shutdown)"""
+        if self._task is None:
+            return
+        await self.queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        
+        while not stopping:
+            item = await self.queue.get()
+            if item is _STOP:
+                break
+            
+            # Collect more candles until the batch is full or the wait window ends
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        # Epoch ms -> naive UTC datetime for the whole batch at once
+        records = [
+            (coin_id, EPOCH + timedelta(milliseconds=timestamp_ms), *prices)
+            for coin_id, timestamp_ms, *prices in batch
+        ]
+        try:
+            await insert_candles_1m(records)
+        except Exception as e:
+            print(f"❌ Error saving {len(batch)} candles: {e}", flush=True)
@@ -9,17 +9,42 @@ from config import CLEANUP_ENABLED, RETENTION_DAYS_1M
 
 async def cleanup_old_candles(retention_days: int = 7):
     """
-    Delete candles older than retention_days from candle_data_1m table
+    Remove candles older than retention_days from candle_data_1m table
+    
+    Drops whole hypertable chunks with TimescaleDB drop_chunks (metadata-only,
+    no per-row WAL or dead tuples). Rows of a chunk that is only partly past
+    the cutoff stay until the whole chunk is. Falls back to a row DELETE if
+    drop_chunks is not available (e.g. candle_data_1m is a plain table).
     
     Args:
         retention_days: Number of days to keep (default: 7 days)
     
     Returns:
-        Number of rows deleted
+        Number of chunks dropped (or rows deleted by the DELETE fallback)
     """
     cutoff_time = datetime.utcnow() - timedelta(days=retention_days)
     
     async with async_session() as session:
+        try:
+            result = await session.execute(
+                text("""
+                    SELECT drop_chunks('candle_data_1m', older_than => make_interval(days => :retention_days))
+                """),
+                {"retention_days": retention_days}
+            )
+            dropped_count = len(result.fetchall())
+            await session.commit()
+            
+            if dropped_count > 0:
+                print(f"🗑️  Dropped {dropped_count} chunks older than {retention_days} days (before {cutoff_time})", flush=True)
+            else:
+                print(f"✅ No old chunks to drop (retention: {retention_days} days)", flush=True)
+            
+            return dropped_count
+        except Exception as e:
+            print(f"⚠️  drop_chunks failed ({e}), falling back to DELETE", flush=True)
+            await session.rollback()
+        
         try:
             result = await session.execute(
                 text("""
@@ -43,23 +68,32 @@ async def cleanup_old_candles(retention_days: int = 7):
             return 0
 
 async def get_table_stats():
-    """Get statistics about candle_data_1m table"""
+    """
+    Get statistics about candle_data_1m table
+    
+    Uses catalog/index lookups only (no full hypertable scan):
+    approximate_row_count() for the row count, index-backed MIN/MAX for the
+    time range and the coins table for the coin count
+    """
     async with async_session() as session:
         try:
+            # Stats are informational - never let them hold the DB for long
+            await session.execute(text("SET LOCAL statement_timeout = '2s'"))
             result = await session.execute(
                 text("""
                     SELECT 
-                        COUNT(*) as total_rows,
-                        MIN(timestamp) as oldest_candle,
-                        MAX(timestamp) as newest_candle,
-                        COUNT(DISTINCT coin_id) as total_coins,
+                        approximate_row_count('candle_data_1m') as total_rows,
+                        (SELECT MIN(timestamp) FROM candle_data_1m) as oldest_candle,
+                        (SELECT MAX(timestamp) FROM candle_data_1m) as newest_candle,
+                        (SELECT COUNT(*) FROM coins) as total_coins,
                         pg_size_pretty(pg_total_relation_size('candle_data_1m')) as table_size
-                    FROM candle_data_1m
                 """)
             )
             row = result.fetchone()
+            await session.commit()
             
-            if row and row.total_rows > 0:
+            # approximate_row_count() can be 0 before the first ANALYZE, so check the range
+            if row and row.newest_candle is not None:
                 stats = {
                     "total_rows": row.total_rows,
                     "oldest_candle": row.oldest_candle,
@@ -81,7 +115,7 @@ async def print_cleanup_summary():
     if stats:
         print("=" * 70, flush=True)
         print("📊 Database Statistics:", flush=True)
-        print(f"   Total candles: {stats['total_rows']:,}", flush=True)
+        print(f"   Total candles: ~{stats['total_rows']:,}", flush=True)
         print(f"   Coins tracked: {stats['total_coins']}", flush=True)
         print(f"   Oldest candle: {stats['oldest_candle']}", flush=True)
         print(f"   Newest candle: {stats['newest_candle']}", flush=True)
@@ -0,0 +1,132 @@
+"""
+Shared asyncpg connection pool for hot-path queries
+SQLAlchemy (database.py) stays in place for the less frequent jobs
+"""
+import asyncio
+import asyncpg
+from config import DATABASE_URL
+
+# asyncpg expects a plain postgresql:// DSN (no SQLAlchemy driver suffix)
+ASYNCPG_DSN = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+
+_pool: asyncpg.Pool | None = None
+_pool_lock = asyncio.Lock()
+
+# name -> SQL, prepared on every pool connection when it is opened
+PREPARED_STATEMENTS: dict[str, str] = {}
+
+
+class PreparedConnection(asyncpg.Connection):
+    """Pool connection carrying its server-side prepared hot-path statements"""
+    __slots__ = ("prepared",)
+
+
+def register_statement(name: str, sql: str):
+    """Register a hot-path statement to prepare once per pool connection"""
+    PREPARED_STATEMENTS[name] = sql
+
+
+async def _init_connection(conn: PreparedConnection):
+    conn.prepared = {}
+    for name, sql in PREPARED_STATEMENTS.items():
+        conn.prepared[name] = await conn.prepare(sql)
+
+
+async def get_pool() -> asyncpg.Pool:
+    """Return the shared pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    ASYNCPG_DSN,
+                    min_size=10,
+                    max_size=50,
+                    max_inactive_connection_lifetime=300,
+                    connection_class=PreparedConnection,
+                    init=_init_connection,
+                )
+    return _pool
+
+
+async def close_pool():
+    """Close the shared pool (on shutdown)"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+CANDLE_1M_COLUMNS = ["coin_id", "timestamp", "open", "high", "low", "close", "volume"]
+
+register_statement("insert_candle_1m", """
+    INSERT INTO candle_data_1m (coin_id, timestamp, open, high, low, close, volume)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (coin_id, timestamp) DO NOTHING
+""")
+
+
+async def insert_candles_1m(records: list[tuple]) -> int:
+    """
+    Write a small batch of live 1m candles with the prepared INSERT statement
+    (cheaper than a staging table for the few candles closed per minute)
+    
+    Live candles are only written once closed, so they are final: an existing
+    row is left as is (DO NOTHING) instead of being rewritten. The batch is
+    written atomically in one implicit transaction.
+    
+    Args:
+        records: Tuples of (coin_id, timestamp, open, high, low, close, volume)
+    
+    Returns:
+        Number of records written
+    """
+    if not records:
+        return 0
+    
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.prepared["insert_candle_1m"].executemany(records)
+    return len(records)
+
+
+async def upsert_candles_1m(records: list[tuple]) -> int:
+    """
+    Bulk upsert 1m candles: COPY into a temp staging table, then one INSERT ... ON CONFLICT
+    
+    Args:
+        records: Tuples of (coin_id, timestamp, open, high, low, close, volume)
+    
+    Returns:
+        Number of records written
+    """
+    if not records:
+        return 0
+    
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                CREATE TEMP TABLE staging_candle_data_1m ON COMMIT DROP AS
+                SELECT coin_id, timestamp, open, high, low, close, volume
+                FROM candle_data_1m WITH NO DATA
+            """)
+            await conn.copy_records_to_table(
+                "staging_candle_data_1m",
+                records=records,
+                columns=CANDLE_1M_COLUMNS
+            )
+            await conn.execute("""
+                INSERT INTO candle_data_1m (coin_id, timestamp, open, high, low, close, volume)
+                SELECT DISTINCT ON (coin_id, timestamp)
+                    coin_id, timestamp, open, high, low, close, volume
+                FROM staging_candle_data_1m
+                ORDER BY coin_id, timestamp
+                ON CONFLICT (coin_id, timestamp) DO UPDATE
+                SET open = EXCLUDED.open,
+                    high = EXCLUDED.high,
+                    low = EXCLUDED.low,
+                    close = EXCLUDED.close,
+                    volume = EXCLUDED.volume
+            """)
+    return len(records)
@@ -1,6 +1,12 @@
 import asyncio
+import logging
+import uvloop
 from binance_ws import start
+from config import LOG_LEVEL
 
 if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # uvloop: faster event loop for the websocket/Redis/asyncpg I/O
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(start())
 
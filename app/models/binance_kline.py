@@ -0,0 +1,30 @@
+import msgspec
+
+# Only the fields handle_message reads are declared: msgspec skips every other
+# key without allocating it. gc=False - these frames hold no reference cycles,
+# so the GC never has to track them.
+
+
+class Kline(msgspec.Struct, gc=False):
+    t: int      # Kline open time (ms)
+    s: str      # Symbol, e.g. BTCUSDT
+    i: str      # Interval, e.g. 1m
+    o: str
+    h: str
+    l: str
+    c: str
+    v: str
+    x: bool     # Is this kline closed?
+
+
+class KlineEvent(msgspec.Struct, gc=False):
+    E: int      # Event time (ms)
+    k: Kline
+
+
+class KlineStream(msgspec.Struct, gc=False):
+    """Combined stream frame: {"stream": "...", "data": {...}} (stream name is not used)"""
+    data: KlineEvent
+
+
+kline_stream_decoder = msgspec.json.Decoder(KlineStream)
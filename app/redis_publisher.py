@@ -1,10 +1,18 @@
-import json
+import asyncio
 import redis.asyncio as redis
 from config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
 
+# Sentinel telling the sender loop to stop
+_STOP = object()
+
+
 class RedisPublisher:
 
-    def __init__(self):
+    def __init__(self, max_pending: int = 1000):
+        """
+        Args:
+            max_pending: Pipelines waiting for the background sender before send() blocks
+        """
         self.redis = redis.Redis(
             host=REDIS_HOST,
             port=REDIS_PORT,
@@ -12,6 +20,62 @@ class RedisPublisher:
             password=REDIS_PASSWORD,
             decode_responses=True
         )
+        self.send_queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._task: asyncio.Task | None = None
+
+    def pipeline(self):
+        """Non-transactional pipeline: queued commands go out in one round-trip"""
+        return self.redis.pipeline(transaction=False)
+
+    def start(self):
+        """Start the background sender loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def send(self, pipe):
+        """
+        Hand a filled pipeline to the background sender (fire-and-forget)
+        
+        The caller does not wait for Redis replies (PUBLISH subscriber counts
+        are never used). Pipelines queued while a round-trip is in flight are
+        merged and sent together, in send order, so per-channel ordering is
+        kept. Without a running sender it is executed inline.
+        """
+        if self._task is None:
+            await pipe.execute()
+            return
+        await self.send_queue.put(pipe)
+
+    async def close(self):
+        """Send everything still queued and stop the sender loop (on shutdown)"""
+        if self._task is None:
+            return
+        await self.send_queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        stopping = False
+        
+        while not stopping:
+            pipe = await self.send_queue.get()
+            if pipe is _STOP:
+                break
+            
+            # Merge every pipeline queued meanwhile into this one:
+            # one socket write and one batch of replies per round-trip
+            while not self.send_queue.empty():
+                queued = self.send_queue.get_nowait()
+                if queued is _STOP:
+                    stopping = True
+                    break
+                pipe.command_stack.extend(queued.command_stack)
+            
+            try:
+                await pipe.execute()
+            except Exception as e:
+                print(f"❌ Error sending {len(pipe)} Redis commands: {e}", flush=True)
+
 
-    async def publish_price(self, channel: str, data: dict):
-        await self.redis.publish(channel, json.dumps(data))
+# Shared instance: one Redis connection pool for the whole service
+publisher = RedisPublisher()